@@ -1,14 +1,21 @@
-import json
+import asyncio
+import base64
+import binascii
+import gzip
+import hashlib
+import io
 import logging
 import os
 import re
-import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from pathlib import Path
 
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse, Response
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+import orjson
+from PIL import Image
 from pydantic import BaseModel
 from together import Together
 
@@ -25,24 +32,19 @@ logger.propagate = False
 ROOT = Path(__file__).resolve().parent
 
 
+_ENV_RE = re.compile(r"^\s*(?:export\s+)?([^#=\s][^=\s]*)\s*=\s*(.*?)\s*$")
+
+
 def _load_dotenv():
     env_path = ROOT / ".env"
     if not env_path.exists():
         return
-    for raw_line in env_path.read_text().splitlines():
-        line = raw_line.strip()
-        if not line or line.startswith("#"):
-            continue
-        if line.startswith("export "):
-            line = line[len("export ") :].strip()
-        key, sep, value = line.partition("=")
-        if not sep:
-            continue
-        key = key.strip()
-        value = value.strip()
-        if not key:
+    for line in env_path.read_text().splitlines():
+        match = _ENV_RE.match(line)
+        if not match:
             continue
-        if value and value[0] == value[-1] and value[0] in {"'", '"'}:
+        key, value = match.groups()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
             value = value[1:-1]
         os.environ.setdefault(key, value)
 
@@ -51,6 +53,12 @@ _load_dotenv()
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY", "")
 TOGETHER_MODEL = "google/gemma-3n-E4B-it"
 MAX_TOKENS = 48
+# Frames whose dHash differs by at most this many bits reuse the last result.
+HASH_DISTANCE = 5
+# Frames are downscaled and re-encoded before upload to keep the payload small.
+MAX_SIDE = 512
+JPEG_QUALITY = 45
+WARMUP_TIMEOUT = 3.0
 TOGETHER_SYSTEM_PROMPT = "Only respond in JSON."
 TOGETHER_RESPONSE_FORMAT = {
     "type": "json_schema",
@@ -87,8 +95,10 @@ PROMPT = (
 )
 
 client = None
-_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="together")
+_inflight = None
 _last_result = None
+_last_hash = None
 
 
 class ImageRequest(BaseModel):
@@ -111,44 +121,109 @@ def _normalize_image_url(image_url: str) -> str:
     return f"data:image/jpeg;base64,{image_url}"
 
 
+def _frame_hash(image: Image.Image) -> int:
+    pixels = list(image.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        offset = row * 9
+        for col in range(8):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def _prepare_frame(data: bytes) -> tuple[str, int | None]:
+    """Decode the frame once, hash it and shrink it before upload."""
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail((MAX_SIDE, MAX_SIDE), Image.BILINEAR)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        frame_hash = _frame_hash(image)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=JPEG_QUALITY, optimize=False)
+    except Exception as exc:
+        logger.debug("Frame decode failed: %s", exc)
+        encoded = base64.b64encode(data).decode("ascii")
+        return f"data:image/jpeg;base64,{encoded}", None
+    encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
+    return f"data:image/jpeg;base64,{encoded}", frame_hash
+
+
+def _prepare_image_url(image_url: str) -> tuple[str, int | None]:
+    if image_url.startswith("data:"):
+        _, sep, payload = image_url.partition(",")
+        if not sep:
+            # Not a base64 data URL we can decode: pass it through untouched
+            return _normalize_image_url(image_url), None
+    else:
+        payload = image_url
+    try:
+        data = base64.b64decode(payload)
+    except (binascii.Error, ValueError) as exc:
+        logger.debug("Frame decode failed: %s", exc)
+        return _normalize_image_url(image_url), None
+    return _prepare_frame(data)
+
+
+def _warm_connection():
+    """Open the pooled TLS connection so the first /analyze skips the handshake."""
+    start = time.perf_counter()
+    try:
+        client.with_options(max_retries=0, timeout=WARMUP_TIMEOUT).models.list()
+    except Exception as exc:
+        logger.warning("Together warmup failed: %s", exc)
+        return
+    logger.info("Together connection warmed in %.2fs", time.perf_counter() - start)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     _init_client()
+    warmup = asyncio.get_running_loop().run_in_executor(_executor, _warm_connection)
+    try:
+        await asyncio.wait_for(asyncio.shield(warmup), WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Together warmup still running after %.0fs; continuing", WARMUP_TIMEOUT)
     yield
 
 
 app = FastAPI(title="CodexVision Focus", lifespan=lifespan)
 
 
+_JSON_OBJ_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+
 def _parse_json_payload(raw: str) -> dict | None:
     if not raw:
         return None
     candidate = raw.strip()
     if not candidate.startswith("{"):
-        match = re.search(r"\{.*\}", raw, re.DOTALL)
+        if candidate.find("{") < 0:
+            return None
+        match = _JSON_OBJ_RE.search(candidate)
         if not match:
             return None
         candidate = match.group(0)
     try:
-        return json.loads(candidate)
-    except json.JSONDecodeError:
+        return orjson.loads(candidate)
+    except orjson.JSONDecodeError:
         return None
 
 
+_BOOLS = {"true": True, "false": False, "1": True, "0": False, "yes": True, "no": False}
+
+
 def _to_bool(value):
-    if isinstance(value, bool):
+    if value is True or value is False:
         return value
     if value is None:
         return None
-    text = str(value).strip().lower()
-    if text in {"true", "1", "yes"}:
-        return True
-    if text in {"false", "0", "no"}:
-        return False
-    return None
+    return _BOOLS.get(str(value).strip().lower())
 
 
 def _parse_response(text: str) -> dict:
+    # The response schema is strict, so anything that fails to parse is an error
+    # rather than free text worth scraping for a status line.
     raw = (text or "").strip()
     data = _parse_json_payload(raw)
     if data:
@@ -156,9 +231,7 @@ def _parse_response(text: str) -> dict:
         looking_at_camera = _to_bool(data.get("looking_at_camera"))
         phone_visible = _to_bool(data.get("phone_visible"))
 
-        if person_present is None or looking_at_camera is None or phone_visible is None:
-            line = ""
-        else:
+        if person_present is not None and looking_at_camera is not None and phone_visible is not None:
             if person_present is False:
                 looking_at_camera = False
                 phone_visible = False
@@ -172,7 +245,6 @@ def _parse_response(text: str) -> dict:
                 reason = "not_looking"
             else:
                 reason = "focused"
-            line = f"{status}: {reason}"
             detail_map = {
                 "phone": "phone visible",
                 "not_looking": "not looking at camera",
@@ -190,45 +262,17 @@ def _parse_response(text: str) -> dict:
                     "phone_visible": phone_visible,
                 },
             }
-    else:
-        line = raw.splitlines()[0].strip() if raw else ""
-    status_part, reason = (line.split(":", 1) + [""])[:2]
-    status = status_part.strip().upper()
-    reason = reason.strip().lower().replace(" ", "_")
-
-    if status.startswith("FOCUS"):
-        status = "FOCUSED"
-    elif status.startswith("DISTRACT"):
-        status = "DISTRACTED"
-    else:
-        status = "DISTRACTED"
-
-    if reason in {"away", "looking", "looking_away"}:
-        reason = "not_looking"
-    if reason not in {"phone", "not_looking", "no_person", "focused"}:
-        reason = "focused" if status == "FOCUSED" else "unknown"
-    if status == "FOCUSED":
-        reason = "focused"
-
-    detail_map = {
-        "phone": "phone visible",
-        "not_looking": "not looking at camera",
-        "no_person": "no person in frame",
-        "focused": "focused",
-        "unknown": "unclear, treating as distracted",
-    }
-
     return {
-        "label": status,
-        "distracted": status == "DISTRACTED",
-        "reason": reason,
-        "detail": detail_map.get(reason, reason),
+        "label": "ERROR",
+        "distracted": False,
+        "reason": "parse_error",
+        "detail": raw[:120] or "empty response",
     }
 
 
-def _analyze_together(image_url: str) -> dict:
+def _analyze_together(image_url: str, on_token=None) -> dict:
     _init_client()
-    start = time.time()
+    start = time.perf_counter()
     image_url = _normalize_image_url(image_url)
     messages = [
         {"role": "system", "content": TOGETHER_SYSTEM_PROMPT},
@@ -250,19 +294,19 @@ def _analyze_together(image_url: str) -> dict:
             response_format=TOGETHER_RESPONSE_FORMAT,
         )
         chunks = []
+        append = chunks.append
         for token in response:
-            if not hasattr(token, "choices"):
+            try:
+                content = token.choices[0].delta.content
+            except (AttributeError, IndexError, TypeError):
                 continue
-            choice = (token.choices or [None])[0]
-            if not choice or not hasattr(choice, "delta"):
-                continue
-            delta = choice.delta
-            content = getattr(delta, "content", None)
             if content:
-                chunks.append(content)
+                append(content)
+                if on_token is not None:
+                    on_token(content)
         raw = "".join(chunks).strip()
         parsed = _parse_response(raw)
-        parsed["elapsed"] = round(time.time() - start, 2)
+        parsed["elapsed"] = round(time.perf_counter() - start, 2)
         parsed["raw"] = raw
         return parsed
     except Exception as exc:
@@ -277,9 +321,35 @@ def _analyze_together(image_url: str) -> dict:
         }
 
 
+def _etag(body: bytes) -> str:
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+def _cached_response(
+    request: Request, body: bytes, media_type: str, etag: str, gzipped: bytes | None = None
+) -> Response:
+    headers = {"Cache-Control": "public, max-age=3600"}
+    if gzipped is not None:
+        headers["Vary"] = "Accept-Encoding"
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            body = gzipped
+            etag = f'{etag[:-1]}-gzip"'
+            headers["Content-Encoding"] = "gzip"
+    headers["ETag"] = etag
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+_CONFIG_BYTES = orjson.dumps({"backend": "together", "model": TOGETHER_MODEL})
+_CONFIG_ETAG = _etag(_CONFIG_BYTES)
+
+
 @app.get("/")
-def index():
-    return HTMLResponse(INDEX_HTML)
+def index(request: Request):
+    return _cached_response(
+        request, _INDEX_BYTES, "text/html; charset=utf-8", _INDEX_ETAG, _INDEX_GZIP
+    )
 
 @app.get("/favicon.ico")
 def favicon():
@@ -287,32 +357,81 @@ def favicon():
 
 
 @app.get("/config")
-def config():
-    return {"backend": "together", "model": TOGETHER_MODEL}
+def config(request: Request):
+    return _cached_response(request, _CONFIG_BYTES, "application/json", _CONFIG_ETAG)
+
+
+async def _run_analysis(prepare, frame, on_token=None) -> dict:
+    global _last_result, _last_hash
+    loop = asyncio.get_running_loop()
+    image_url, frame_hash = await loop.run_in_executor(_executor, prepare, frame)
+    if (
+        _last_result
+        and frame_hash is not None
+        and _last_hash is not None
+        and (frame_hash ^ _last_hash).bit_count() <= HASH_DISTANCE
+    ):
+        logger.info("Frame unchanged; returning cached result")
+        return {**_last_result, "cache_hit": True}
+    result = await loop.run_in_executor(_executor, _analyze_together, image_url, on_token)
+    _last_result = {**result, "stale": False, "cache_hit": False}
+    _last_hash = frame_hash if result["label"] != "ERROR" else None
+    logger.info(
+        "Result %s reason=%s elapsed=%.2fs",
+        result["label"],
+        result["reason"],
+        result["elapsed"],
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Raw output: %s", result.get("raw", ""))
+    return _last_result
+
+
+def _clear_inflight(task: asyncio.Task):
+    global _inflight
+    if _inflight is task:
+        _inflight = None
+
+
+def _sse(payload: dict, event: str | None = None) -> bytes:
+    prefix = f"event: {event}\n".encode("ascii") if event else b""
+    return b"".join((prefix, b"data: ", orjson.dumps(payload), b"\n\n"))
+
+
+async def _stream_events(task: asyncio.Task, tokens: asyncio.Queue | None, extra: dict | None = None):
+    if tokens is not None:
+        while (content := await tokens.get()) is not None:
+            yield _sse({"token": content})
+    result = await asyncio.shield(task)
+    yield _sse({**result, **extra} if extra else result, event="result")
+
+
+def _analysis_response(prepare, frame) -> StreamingResponse:
+    global _inflight
+    if _inflight is not None:
+        logger.info("Analyze coalesced onto in-flight request")
+        events = _stream_events(_inflight, None, {"coalesced": True})
+        return StreamingResponse(events, media_type="text/event-stream")
+    loop = asyncio.get_running_loop()
+    tokens = asyncio.Queue()
+
+    def on_token(content: str):
+        loop.call_soon_threadsafe(tokens.put_nowait, content)
+
+    _inflight = asyncio.ensure_future(_run_analysis(prepare, frame, on_token))
+    _inflight.add_done_callback(_clear_inflight)
+    _inflight.add_done_callback(lambda _: tokens.put_nowait(None))
+    return StreamingResponse(_stream_events(_inflight, tokens), media_type="text/event-stream")
 
 
 @app.post("/analyze")
-def analyze(req: ImageRequest):
-    global _last_result
-    if not _lock.acquire(blocking=False):
-        if _last_result:
-            logger.info("Analyze skipped (busy); returning stale result")
-            return {**_last_result, "stale": True}
-        logger.info("Analyze skipped (busy); no cached result")
-        return {"label": "BUSY", "reason": "busy", "detail": "model busy", "stale": True}
-    try:
-        result = _analyze_together(req.image)
-        _last_result = {**result, "stale": False}
-        logger.info(
-            "Result %s reason=%s elapsed=%.2fs",
-            result["label"],
-            result["reason"],
-            result["elapsed"],
-        )
-        logger.debug("Raw output: %s", result.get("raw", ""))
-        return _last_result
-    finally:
-        _lock.release()
+async def analyze(req: ImageRequest):
+    return _analysis_response(_prepare_image_url, req.image)
+
+
+@app.post("/analyze_raw")
+async def analyze_raw(request: Request):
+    return _analysis_response(_prepare_frame, await request.body())
 
 
 INDEX_HTML = """<!doctype html>
@@ -541,7 +660,7 @@ INDEX_HTML = """<!doctype html>
           <button id="start">Start</button>
           <button id="stop" disabled>Stop</button>
           <div class="slider">
-            <label for="interval"><span>Polling Interval</span><span id="interval-val">2.5s</span></label>
+            <label for="interval"><span>Max Polling Interval</span><span id="interval-val">2.5s</span></label>
             <input type="range" id="interval" min="500" max="10000" step="500" value="2500" />
           </div>
         </div>
@@ -569,10 +688,106 @@ INDEX_HTML = """<!doctype html>
       const startBtn = document.getElementById("start");
       const stopBtn = document.getElementById("stop");
 
+      // Mirror + JPEG encode run in a worker on the transferred canvas so the
+      // UI thread only grabs an ImageBitmap per frame.
+      const encoderSrc = `
+        let canvas;
+        let ctx;
+        self.onmessage = async (e) => {
+          if (e.data.cmd === "init") {
+            canvas = e.data.canvas;
+            ctx = canvas.getContext("2d");
+            return;
+          }
+          const bitmap = e.data.bitmap;
+          canvas.width = bitmap.width;
+          canvas.height = bitmap.height;
+          ctx.setTransform(-1, 0, 0, 1, canvas.width, 0);
+          ctx.drawImage(bitmap, 0, 0);
+          bitmap.close();
+          const blob = await canvas.convertToBlob({ type: "image/jpeg", quality: 0.6 });
+          self.postMessage({ id: e.data.id, blob });
+        };
+      `;
+      const encoder = new Worker(
+        URL.createObjectURL(new Blob([encoderSrc], { type: "application/javascript" }))
+      );
+      const offscreen = canvas.transferControlToOffscreen();
+      encoder.postMessage({ cmd: "init", canvas: offscreen }, [offscreen]);
+      const pendingEncodes = new Map();
+      let encodeId = 0;
+      encoder.onmessage = (e) => {
+        const resolve = pendingEncodes.get(e.data.id);
+        pendingEncodes.delete(e.data.id);
+        if (resolve) resolve(e.data.blob);
+      };
+
+      async function encodeFrame() {
+        const bitmap = await createImageBitmap(video);
+        const id = ++encodeId;
+        return new Promise((resolve) => {
+          pendingEncodes.set(id, resolve);
+          encoder.postMessage({ cmd: "frame", id, bitmap }, [bitmap]);
+        });
+      }
+
       let stream;
       let isRunning = false;
       let currentInterval = 2500;
       let timeoutId;
+      let lastHash = null;
+      let lastData = null;
+      let lastLabel = null;
+      let nextDelay = 500;
+
+      // Back off while the label is stable, snap back to the floor on any change.
+      const MIN_INTERVAL = 500;
+
+      function adaptDelay(label) {
+        if (label === lastLabel) {
+          nextDelay = Math.min(nextDelay * 1.5, currentInterval);
+        } else {
+          nextDelay = MIN_INTERVAL;
+        }
+        lastLabel = label;
+      }
+
+      // 8x8 average hash of the raw video frame; near-identical frames skip the POST.
+      const HASH_DISTANCE = 4;
+      const hashCanvas = new OffscreenCanvas(8, 8);
+      const hashCtx = hashCanvas.getContext("2d", { willReadFrequently: true });
+
+      function frameHash() {
+        hashCtx.drawImage(video, 0, 0, 8, 8);
+        const px = hashCtx.getImageData(0, 0, 8, 8).data;
+        const luma = new Float32Array(64);
+        let sum = 0;
+        for (let i = 0; i < 64; i++) {
+          const v = px[i * 4] * 0.299 + px[i * 4 + 1] * 0.587 + px[i * 4 + 2] * 0.114;
+          luma[i] = v;
+          sum += v;
+        }
+        const mean = sum / 64;
+        let hi = 0;
+        let lo = 0;
+        for (let i = 0; i < 32; i++) {
+          if (luma[i] > mean) hi |= 1 << i;
+          if (luma[i + 32] > mean) lo |= 1 << i;
+        }
+        return [hi >>> 0, lo >>> 0];
+      }
+
+      function popcount(x) {
+        x -= (x >>> 1) & 0x55555555;
+        x = (x & 0x33333333) + ((x >>> 2) & 0x33333333);
+        return Math.imul((x + (x >>> 4)) & 0x0f0f0f0f, 0x01010101) >>> 24;
+      }
+
+      function isDuplicate(hash) {
+        if (!lastHash || !lastData) return false;
+        const distance = popcount(hash[0] ^ lastHash[0]) + popcount(hash[1] ^ lastHash[1]);
+        return distance <= HASH_DISTANCE;
+      }
 
       intervalInput.addEventListener("input", (e) => {
         currentInterval = parseInt(e.target.value, 10);
@@ -598,33 +813,76 @@ INDEX_HTML = """<!doctype html>
         }
       }
 
+      async function readEvents(res, onEvent) {
+        const reader = res.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        while (true) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+          let sep;
+          while ((sep = buffer.indexOf("\\n\\n")) >= 0) {
+            const block = buffer.slice(0, sep);
+            buffer = buffer.slice(sep + 2);
+            let event = "message";
+            let payload = "";
+            for (const line of block.split("\\n")) {
+              if (line.startsWith("event: ")) event = line.slice(7);
+              else if (line.startsWith("data: ")) payload += line.slice(6);
+            }
+            if (payload) onEvent(event, JSON.parse(payload));
+          }
+        }
+      }
+
       async function loop() {
         if (!isRunning) return;
         if (!video.videoWidth) {
           timeoutId = setTimeout(loop, 100);
           return;
         }
-        canvas.width = video.videoWidth;
-        canvas.height = video.videoHeight;
-        const ctx = canvas.getContext("2d");
-        ctx.translate(canvas.width, 0);
-        ctx.scale(-1, 1);
-        ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
+        const hash = frameHash();
+        if (isDuplicate(hash)) {
+          setStatus({ ...lastData, stale: true });
+          adaptDelay(lastData.label);
+          timeoutId = setTimeout(loop, nextDelay);
+          return;
+        }
 
         try {
-          const res = await fetch("/analyze", {
+          const blob = await encodeFrame();
+          const res = await fetch("/analyze_raw", {
             method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ image: canvas.toDataURL("image/jpeg", 0.6) }),
+            headers: { "Content-Type": "image/jpeg" },
+            body: blob,
           });
-          const data = await res.json();
-          setStatus(data);
+          if (!res.ok) {
+            // Rejected before streaming began (e.g. 413); there is no SSE body
+            detailEl.textContent = `Server error (${res.status}).`;
+          } else {
+            let partial = "";
+            await readEvents(res, (event, data) => {
+              if (event === "result") {
+                // Only a real answer may stand in for later near-identical frames
+                if (data.label !== "ERROR") {
+                  lastHash = hash;
+                  lastData = data;
+                }
+                setStatus(data);
+                adaptDelay(data.label);
+              } else if (data.token) {
+                partial += data.token;
+                detailEl.textContent = partial;
+              }
+            });
+          }
         } catch (err) {
           detailEl.textContent = "Error calling server.";
         }
 
         if (isRunning) {
-          timeoutId = setTimeout(loop, currentInterval);
+          timeoutId = setTimeout(loop, nextDelay);
         }
       }
 
@@ -649,6 +907,10 @@ INDEX_HTML = """<!doctype html>
         }
         startBtn.disabled = false;
         stopBtn.disabled = true;
+        lastHash = null;
+        lastData = null;
+        lastLabel = null;
+        nextDelay = MIN_INTERVAL;
         badge.className = "status-pill UNKNOWN";
         badge.textContent = "Stopped";
       };
@@ -663,6 +925,9 @@ INDEX_HTML = """<!doctype html>
   </body>
 </html>
 """
+_INDEX_BYTES = INDEX_HTML.encode("utf-8")
+_INDEX_ETAG = _etag(_INDEX_BYTES)
+_INDEX_GZIP = gzip.compress(_INDEX_BYTES, compresslevel=9, mtime=0)
 
 
 if __name__ == "__main__":
@@ -1,96 +1,44 @@
+import asyncio
 import atexit
-import base64
+import gzip
+import hashlib
 import io
-import json
-import os
 import re
 import shutil
-import subprocess
-import threading
 import time
-import urllib.error
-import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
+import httpx
+import orjson
+import pybase64
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+from pydantic import BaseModel, Field
 from PIL import Image
 
 ROOT = Path(__file__).resolve().parent
-os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
-os.environ.setdefault("TRANSFORMERS_IMAGE_PROCESSOR_USE_FAST", "0")
-os.environ.setdefault("TRANSFORMERS_USE_FAST", "0")
-if not os.getenv("TMPDIR"):
-    tmp_dir = ROOT / "tmp"
-    tmp_dir.mkdir(exist_ok=True)
-    os.environ["TMPDIR"] = str(tmp_dir)
-from mlx_vlm import generate, load
-from mlx_vlm.prompt_utils import apply_chat_template
-from mlx_vlm.utils import load_config
-
-def _find_model_dir(patterns):
-    for pattern in patterns:
-        for match in sorted(ROOT.glob(pattern)):
-            if match.is_dir():
-                return str(match)
-    return None
-
-def _find_coreml_package(path: Path):
-    for entry in path.glob("*.mlpackage"):
-        return entry
-    return None
-
-def _ensure_coreml_vision_tower(model_path: Path, override: str | None):
-    if not model_path.is_dir():
-        return
-    if _find_coreml_package(model_path):
-        return
-    candidates = []
-    if override:
-        candidates.append(Path(override))
-    candidates.extend([
-        ROOT / "llava-fastvithd_0.5b_stage3",
-        ROOT / "llava-fastvithd_0.5b_stage3_llm.fp16",
-    ])
-    src = None
-    for cand in candidates:
-        if cand.is_dir() and cand.suffix == ".mlpackage":
-            src = cand
-        elif cand.is_dir():
-            src = _find_coreml_package(cand)
-        elif cand.suffix == ".mlpackage" and cand.exists():
-            src = cand
-        if src:
-            break
-    if not src:
-        return
-    dest = model_path / src.name
-    if dest.exists():
-        return
-    try:
-        os.symlink(src, dest)
-    except OSError:
-        shutil.copytree(src, dest)
-    print(f"Using vision tower from {src}")
 
 # GLOBAL STATE
-model = None
-processor = None
-config = None
-prompt = None
 groq_client = None
+http_client = None
 _initialized = False
-_lock = threading.Lock()
-_last_result = None
+_inflight = None
+_ready = None
+_load_error = None
 _llamacpp_proc = None
+_frame_cache = OrderedDict()
+# The blocking Groq SDK gets its own pool; llama.cpp/Ollama use http_client.
+_http_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="groq")
+atexit.register(_http_pool.shutdown, wait=False)
 
 # SETTINGS (hardcoded)
-MODEL_PATH = "mlx-community/SmolVLM2-500M-Video-Instruct-mlx"
-VISION_TOWER_PATH = None
-MAX_SIDE = 384
-MAX_TOKENS = 128
+MAX_IMAGE_BYTES = 256 * 1024
+MAX_BODY_BYTES = MAX_IMAGE_BYTES + 1024
+FRAME_CACHE_SIZE = 32
+HASH_DISTANCE = 4
 MAX_TOKENS_CLASSIFY = 32
 BACKEND = "llamacpp"
 GROQ_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
@@ -151,28 +99,25 @@ def _resolve_llamacpp_bin():
         return LLAMACPP_BIN
     return shutil.which(LLAMACPP_BIN)
 
-def _llamacpp_is_ready():
+async def _llamacpp_is_ready():
     try:
-        with urllib.request.urlopen(f"{LLAMACPP_BASE_URL}/v1/models", timeout=1):
-            return True
-    except urllib.error.HTTPError:
+        await http_client.get(f"{LLAMACPP_BASE_URL}/v1/models", timeout=1)
         return True
-    except Exception:
+    except httpx.HTTPError:
         return False
 
-def _stop_llamacpp_server():
-    global _llamacpp_proc
-    if not _llamacpp_proc or _llamacpp_proc.poll() is not None:
+async def _stop_llamacpp_server():
+    if not _llamacpp_proc or _llamacpp_proc.returncode is not None:
         return
     _llamacpp_proc.terminate()
     try:
-        _llamacpp_proc.wait(timeout=5)
-    except Exception:
+        await asyncio.wait_for(_llamacpp_proc.wait(), timeout=5)
+    except asyncio.TimeoutError:
         _llamacpp_proc.kill()
 
-def _ensure_llamacpp_server():
+async def _ensure_llamacpp_server():
     global _llamacpp_proc
-    if not LLAMACPP_AUTOSTART or _llamacpp_is_ready():
+    if not LLAMACPP_AUTOSTART or await _llamacpp_is_ready():
         return
     bin_path = _resolve_llamacpp_bin()
     if not bin_path:
@@ -192,19 +137,19 @@ def _ensure_llamacpp_server():
     ]
     cmd.extend(LLAMACPP_ARGS)
     print("Starting llama.cpp server...")
-    _llamacpp_proc = subprocess.Popen(cmd)
-    atexit.register(_stop_llamacpp_server)
-    deadline = time.time() + LLAMACPP_START_TIMEOUT
-    while time.time() < deadline:
-        if _llamacpp_is_ready():
+    _llamacpp_proc = await asyncio.create_subprocess_exec(*cmd)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LLAMACPP_START_TIMEOUT
+    while loop.time() < deadline:
+        if await _llamacpp_is_ready():
             return
-        if _llamacpp_proc.poll() is not None:
+        if _llamacpp_proc.returncode is not None:
             raise RuntimeError("llama-server exited before becoming ready.")
-        time.sleep(0.25)
+        await asyncio.sleep(0.05)
     raise RuntimeError("llama-server did not become ready in time.")
 
 def _init_backend():
-    global model, processor, config, prompt, groq_client, _initialized
+    global groq_client, _initialized
     if _initialized: return
 
     if BACKEND == "groq":
@@ -220,97 +165,176 @@ def _init_backend():
         _initialized = True
         return
     if BACKEND == "llamacpp":
-        _ensure_llamacpp_server()
         print(f"Using llama.cpp server: {LLAMACPP_URL}")
         _initialized = True
         return
+    raise RuntimeError(f"Unknown BACKEND {BACKEND!r}; use llamacpp, ollama or groq.")
 
-    def _load_model(extra_kwargs=None):
-        kwargs = {}
-        if extra_kwargs:
-            kwargs.update(extra_kwargs)
-        return load(MODEL_PATH, **kwargs)
-
-    print(f"Loading local model: {MODEL_PATH}")
-    config = load_config(MODEL_PATH)
-    if config.get("model_type") in {"llava_qwen2", "fastvlm"}:
-        _ensure_coreml_vision_tower(Path(MODEL_PATH), VISION_TOWER_PATH)
-    model_type = config.get("model_type")
-    is_jina = model_type == "jvlm"
-    try:
-        load_kwargs = {"trust_remote_code": not is_jina}
-        model, processor = _load_model(load_kwargs)
-    except ValueError as e:
-        if "parameters not in model" in str(e):
-            print("Retrying load with only_llm=True (FastVLM checkpoint mapping).")
-            retry_kwargs = {"only_llm": True, "trust_remote_code": not is_jina}
-            model, processor = _load_model(retry_kwargs)
-        else:
-            raise
-
-    if config.get("model_type") in {"llava_qwen2", "fastvlm"} and getattr(model, "vision_tower", None) is None:
-        raise RuntimeError(
-            "FastVLM requires a CoreML vision encoder (.mlpackage). "
-            "Place one in the model directory or set CODEXVISION_VISION_TOWER. "
-            "Run: python ml-fastvlm/model_export/export_vision_encoder.py "
-            f"--model-path {MODEL_PATH}"
-        )
+async def _load_backend():
+    # llama-server is spawned and polled on the loop; only blocking loads use a thread.
+    if BACKEND == "llamacpp":
+        await _ensure_llamacpp_server()
+    await asyncio.to_thread(_init_backend)
 
-    prompt = apply_chat_template(processor, config, PROMPT, num_images=1)
-    print("Model loaded.")
-    _initialized = True
+def _backend_loaded(task):
+    global _load_error
+    if not task.cancelled() and task.exception():
+        _load_error = task.exception()
+        print(f"[INIT] Backend failed to load: {_load_error}")
+    _ready.set()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    _init_backend()
-    yield
+    global http_client, _ready
+    # Load the backend off the event loop so / and /config answer immediately.
+    _ready = asyncio.Event()
+    app.state.config_bytes = _config_bytes()
+    http_client = httpx.AsyncClient(
+        timeout=120,
+        limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=60),
+    )
+    load_task = asyncio.create_task(_load_backend())
+    load_task.add_done_callback(_backend_loaded)
+    try:
+        yield
+    finally:
+        # Shutdown during startup: stop waiting on llama-server before killing it
+        load_task.cancel()
+        await asyncio.gather(load_task, return_exceptions=True)
+        await _stop_llamacpp_server()
+        await http_client.aclose()
+        http_client = None
 
 app = FastAPI(title="CodexVision", lifespan=lifespan)
 
+def _json(payload: dict, status_code: int = 200) -> Response:
+    return Response(orjson.dumps(payload), status_code=status_code, media_type="application/json")
+
+@app.middleware("http")
+async def limit_body(request: Request, call_next):
+    # Refuse oversized uploads from the header, before the body is read.
+    size = request.headers.get("content-length")
+    if size and size.isdigit() and int(size) > MAX_BODY_BYTES:
+        return _json({"detail": "request too large"}, status_code=413)
+    return await call_next(request)
+
 class ImageRequest(BaseModel):
-    image: str
+    image: str = Field(max_length=MAX_IMAGE_BYTES)
 
-def _resize_pil(image, max_side):
-    if max_side <= 0: return image
-    w, h = image.size
-    scale = max_side / float(max(w, h))
-    if scale >= 1.0: return image
-    return image.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.BICUBIC)
+def _pass_through_data_url(image_url):
+    # Remote backends take the client's JPEG as-is: no decode, no re-encode.
+    if image_url.startswith("data:"): return image_url
+    return f"data:image/jpeg;base64,{image_url}"
 
-def _decode_image(data_url):
+def _hash_data_url(data_url):
     if "," in data_url: data_url = data_url.split(",", 1)[1]
-    return Image.open(io.BytesIO(base64.b64decode(data_url))).convert("RGB")
-
-def _post_json(url, payload, timeout=60):
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        return json.load(resp)
+    try:
+        image = Image.open(io.BytesIO(pybase64.b64decode(data_url, validate=False)))
+        # JPEG only: libjpeg decodes at 1/8 scale inside the IDCT; the hash needs 9x8.
+        image.draft("L", (9, 8))
+        return _frame_hash(image)
+    except (ValueError, OSError):
+        return None
+
+def _frame_hash(image):
+    # 64-bit dHash: sign of horizontal gradients on a 9x8 grayscale thumbnail.
+    px = image.convert("L").resize((9, 8), Image.BILINEAR).tobytes()
+    bits = 0
+    for row in range(0, 72, 9):
+        for col in range(row, row + 8):
+            bits = (bits << 1) | (px[col] > px[col + 1])
+    return bits
+
+def _cached_result(frame_hash):
+    if frame_hash is None: return None
+    for key, result in reversed(_frame_cache.items()):
+        if (key ^ frame_hash).bit_count() <= HASH_DISTANCE:
+            _frame_cache.move_to_end(key)
+            return {**result, "elapsed": 0.0}
+    return None
 
-def _parse_response(text, elapsed):
+def _remember_result(frame_hash, result):
+    if frame_hash is None or result["label"] == "ERROR": return
+    _frame_cache[frame_hash] = result
+    _frame_cache.move_to_end(frame_hash)
+    while len(_frame_cache) > FRAME_CACHE_SIZE:
+        _frame_cache.popitem(last=False)
+
+def _body_template(payload):
+    # Serialize once around a placeholder; requests splice in the image string.
+    prefix, suffix = orjson.dumps(payload).split(b'"__IMAGE__"')
+    return lambda image: prefix + orjson.dumps(image) + suffix
+
+_OLLAMA_BODY = _body_template({
+    "model": OLLAMA_MODEL,
+    "messages": [
+        {"role": "user", "content": OLLAMA_PROMPT, "images": ["__IMAGE__"]}
+    ],
+    "stream": False,
+    "format": OLLAMA_SCHEMA,
+    "options": {"temperature": 0},
+})
+_LLAMACPP_BODY = _body_template({
+    "messages": [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": PROMPT},
+                {"type": "image_url", "image_url": {"url": "__IMAGE__"}},
+            ],
+        }
+    ],
+    "temperature": 0,
+    "max_tokens": MAX_TOKENS_CLASSIFY,
+    "stream": True,
+    **({"model": LLAMACPP_MODEL} if LLAMACPP_MODEL else {}),
+})
+
+async def _post_json(url, body, timeout=60):
+    resp = await http_client.post(
+        url, content=body, headers={"Content-Type": "application/json"}, timeout=timeout
+    )
+    resp.raise_for_status()
+    return orjson.loads(resp.content)
+
+async def _stream_first_line(url, body, timeout=60):
+    # Leaving the stream closes the connection, which stops llama-server generating.
+    text = ""
+    async with http_client.stream(
+        "POST", url, content=body, headers={"Content-Type": "application/json"}, timeout=timeout
+    ) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if not line.startswith("data: ") or line == "data: [DONE]": continue
+            choice = (orjson.loads(line[6:]).get("choices") or [{}])[0]
+            text += (choice.get("delta") or {}).get("content") or ""
+            if "\n" in text.lstrip(): break
+    return text
+
+_FOCUS_PREFIXES = ("FOCUS",)
+_DIST_PREFIXES = ("DISTRACT",)
+
+def _parse_response(text: str, elapsed: float) -> dict:
     raw = (text or "").strip()
     line = raw.splitlines()[0].strip() if raw else ""
-    status_part, reason = (line.split(":", 1) + [""])[:2] if line else ("", "")
+    status_part, _, reason = line.partition(":")
     status_part = status_part.strip().upper()
     reason = reason.strip()
 
-    if status_part.startswith("FOCUS"):
+    if status_part.startswith(_FOCUS_PREFIXES):
         status = "FOCUSED"
-    elif status_part.startswith("DISTRACT"):
+    elif status_part.startswith(_DIST_PREFIXES):
         status = "DISTRACTED"
     else:
-        first = line.split()[0].upper() if line else ""
-        if first.startswith("FOCUS"):
+        first = line.split(None, 1)[0].upper() if line else ""
+        if first.startswith(_FOCUS_PREFIXES):
             status = "FOCUSED"
-        elif first.startswith("DISTRACT"):
-            status = "DISTRACTED"
         else:
             status = "DISTRACTED"
 
     if not reason:
         reason = "unknown"
 
-    reason = reason.strip()
     if len(reason) > 80:
         reason = reason[:77] + "..."
 
@@ -325,7 +349,7 @@ def _parse_response(text, elapsed):
 
 def _analyze_groq(image_url):
     start = time.time()
-    if not image_url.startswith("data:"): image_url = f"data:image/jpeg;base64,{image_url}"
+    image_url = _pass_through_data_url(image_url)
     msgs = [{"role": "user", "content": [{"type": "text", "text": PROMPT}, {"type": "image_url", "image_url": {"url": image_url}}]}]
     
     try:
@@ -347,27 +371,15 @@ def _analyze_groq(image_url):
     print(f"{'='*50}")
     return result
 
-def _analyze_ollama(image_url):
+async def _analyze_ollama(image_url):
     start = time.time()
-    if not image_url.startswith("data:"):
-        image_url = f"data:image/jpeg;base64,{image_url}"
-    image_b64 = image_url.split(",", 1)[1]
-
-    payload = {
-        "model": OLLAMA_MODEL,
-        "messages": [
-            {"role": "user", "content": OLLAMA_PROMPT, "images": [image_b64]}
-        ],
-        "stream": False,
-        "format": OLLAMA_SCHEMA,
-        "options": {"temperature": 0},
-    }
+    image_b64 = _pass_through_data_url(image_url).split(",", 1)[1]
     try:
-        resp = _post_json(f"{OLLAMA_URL}/api/chat", payload, timeout=120)
+        resp = await _post_json(f"{OLLAMA_URL}/api/chat", _OLLAMA_BODY(image_b64), timeout=120)
         raw = resp.get("message", {}).get("content", "")
         print(f"\n{'='*50}")
         print(f"[OLLAMA] Raw: {raw!r}")
-        data = json.loads(raw)
+        data = orjson.loads(raw)
         state = data.get("state", "DISTRACTED")
         reason = data.get("reason", "unknown")
         result = {
@@ -385,30 +397,11 @@ def _analyze_ollama(image_url):
         print(f"[OLLAMA] ERROR: {e}")
         return {"label": "ERROR", "distracted": False, "reason": "error", "what_you_see": str(e), "elapsed": 0}
 
-def _analyze_llamacpp(image_url):
+async def _analyze_llamacpp(image_url):
     start = time.time()
-    if not image_url.startswith("data:"):
-        image_url = f"data:image/jpeg;base64,{image_url}"
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "text", "text": PROMPT},
-                {"type": "image_url", "image_url": {"url": image_url}},
-            ],
-        }
-    ]
-    payload = {
-        "messages": messages,
-        "temperature": 0,
-        "max_tokens": MAX_TOKENS_CLASSIFY,
-    }
-    if LLAMACPP_MODEL:
-        payload["model"] = LLAMACPP_MODEL
+    body = _LLAMACPP_BODY(_pass_through_data_url(image_url))
     try:
-        resp = _post_json(LLAMACPP_URL, payload, timeout=120)
-        choice = (resp.get("choices") or [{}])[0]
-        raw = (choice.get("message") or {}).get("content", "")
+        raw = await _stream_first_line(LLAMACPP_URL, body, timeout=120)
         print(f"\n{'='*50}")
         print(f"[LLAMACPP] Raw: {raw!r}")
         result = _parse_response(raw, time.time() - start)
@@ -419,51 +412,67 @@ def _analyze_llamacpp(image_url):
         print(f"[LLAMACPP] ERROR: {e}")
         return {"label": "ERROR", "distracted": False, "reason": "error", "what_you_see": str(e), "elapsed": 0}
 
-def _analyze_image(image):
-    image = _resize_pil(image, MAX_SIDE)
-    start = time.time()
-    
-    res = generate(model, processor, prompt, [image], max_tokens=MAX_TOKENS_CLASSIFY, temperature=0.0)
-    raw = getattr(res, "text", str(res)).strip()
-    print(f"\n{'='*50}")
-    print(f"[LOCAL] Raw: {raw!r}")
-
-    result = _parse_response(raw, time.time() - start)
-    print(f"[LOCAL] Result -> {result['label']} | {result['elapsed']}s")
-    print(f"{'='*50}")
-    return result
-
 @app.get("/")
-def index(): return HTMLResponse(INDEX_HTML)
-
-@app.get("/config")
-def cfg():
-    model = MODEL_PATH
+def index(request: Request):
+    headers = {"Cache-Control": "public, max-age=3600", "Vary": "Accept-Encoding"}
+    body, etag = _INDEX_BYTES, _INDEX_ETAG
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        body, etag = _INDEX_GZ, _INDEX_GZ_ETAG
+        headers["Content-Encoding"] = "gzip"
+    headers["ETag"] = etag
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="text/html; charset=utf-8", headers=headers)
+
+def _config_bytes():
     if BACKEND == "ollama":
         model = OLLAMA_MODEL or "unset"
     elif BACKEND == "llamacpp":
         model = LLAMACPP_MODEL or Path(LLAMACPP_MODEL_PATH).name
-    return {"backend": BACKEND, "model": model}
+    else:
+        model = GROQ_MODEL
+    return orjson.dumps({"backend": BACKEND, "model": model})
 
-@app.post("/analyze")
-def analyze(req: ImageRequest):
-    global _last_result
-    if not _lock.acquire(blocking=False):
-        print(f"[ANALYZE] Request skipped (busy), returning stale result")
-        return {**_last_result, "stale": True} if _last_result else {"label": "BUSY", "stale": True}
-    try:
-        print(f"\n[ANALYZE] New request received ({BACKEND} backend)")
-        if BACKEND == "groq":
-            res = _analyze_groq(req.image)
-        elif BACKEND == "ollama":
-            res = _analyze_ollama(req.image)
-        elif BACKEND == "llamacpp":
-            res = _analyze_llamacpp(req.image)
+@app.get("/config")
+def cfg(request: Request):
+    headers = {"Cache-Control": "public, max-age=60"}
+    return Response(request.app.state.config_bytes, media_type="application/json", headers=headers)
+
+async def _run_analysis(image_url):
+    if BACKEND == "ollama":
+        res = await _analyze_ollama(image_url)
+    elif BACKEND == "llamacpp":
+        # base64 + JPEG decode off the event loop so / and /config stay responsive
+        frame_hash = await asyncio.to_thread(_hash_data_url, image_url)
+        res = _cached_result(frame_hash)
+        if res:
+            print("[LLAMACPP] Cache hit, skipping inference")
         else:
-            res = _analyze_image(_decode_image(req.image))
-        _last_result = {**res, "stale": False}
-        return _last_result
-    finally: _lock.release()
+            res = await _analyze_llamacpp(image_url)
+            _remember_result(frame_hash, res)
+    else:
+        res = await asyncio.get_running_loop().run_in_executor(_http_pool, _analyze_groq, image_url)
+    return {**res, "stale": False}
+
+def _clear_inflight(task):
+    global _inflight
+    if _inflight is task: _inflight = None
+
+@app.post("/analyze")
+async def analyze(req: ImageRequest):
+    global _inflight
+    if not _ready.is_set():
+        return _json({"label": "LOADING", "stale": True})
+    if _load_error:
+        return _json({"label": "ERROR", "distracted": False, "reason": "error", "what_you_see": str(_load_error), "elapsed": 0})
+    if _inflight is not None:
+        # Single-flight: join the running analysis instead of starting another.
+        print("[ANALYZE] Request coalesced onto in-flight analysis")
+        return _json({**await asyncio.shield(_inflight), "coalesced": True})
+    print(f"\n[ANALYZE] New request received ({BACKEND} backend)")
+    _inflight = asyncio.ensure_future(_run_analysis(req.image))
+    _inflight.add_done_callback(_clear_inflight)
+    return _json(await asyncio.shield(_inflight))
 
 INDEX_HTML = """<!doctype html>
 <html lang="en">
@@ -540,7 +549,7 @@ INDEX_HTML = """<!doctype html>
         backdrop-filter: blur(8px);
         box-shadow: 0 2px 4px rgba(0,0,0,0.1);
       }
-      .badge.UNKNOWN { background: rgba(39, 39, 42, 0.8); color: var(--text-muted); }
+      .badge.UNKNOWN, .badge.LOADING { background: rgba(39, 39, 42, 0.8); color: var(--text-muted); }
       .badge.FOCUSED { background: rgba(34, 197, 94, 0.2); color: #86efac; border: 1px solid rgba(34, 197, 94, 0.3); }
       .badge.DISTRACTED { background: rgba(239, 68, 68, 0.2); color: #fca5a5; border: 1px solid rgba(239, 68, 68, 0.3); }
 
@@ -684,6 +693,12 @@ INDEX_HTML = """<!doctype html>
 </html>
 """
 
+_INDEX_BYTES = INDEX_HTML.encode("utf-8")
+_INDEX_GZ = gzip.compress(_INDEX_BYTES, compresslevel=9, mtime=0)
+_INDEX_ETAG = f'"{hashlib.md5(_INDEX_BYTES).hexdigest()}"'
+_INDEX_GZ_ETAG = f'"{hashlib.md5(_INDEX_GZ).hexdigest()}"'
+
+
 if __name__ == "__main__":
     import argparse, uvicorn, webbrowser
     p = argparse.ArgumentParser()
@@ -692,7 +707,6 @@ if __name__ == "__main__":
     p.add_argument("--port", type=int, default=8081)
     args = p.parse_args()
     if args.groq: BACKEND = "groq"
-    _init_backend()
     if args.host in {"0.0.0.0", "127.0.0.1", "localhost"}:
         try: webbrowser.open(f"http://localhost:{args.port}")
         except: pass
@@ -1,15 +1,21 @@
-import json
+import asyncio
+import binascii
+import hashlib
+import io
 import logging
 import os
-import threading
+import re
 import time
-import urllib.error
-import urllib.request
-from contextlib import asynccontextmanager
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
 from pathlib import Path
 
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse, Response
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import Response
+import httpx
+import orjson
+import pybase64
+from PIL import Image
 from pydantic import BaseModel
 
 LOG_LEVEL = "INFO"
@@ -55,6 +61,11 @@ LMSTUDIO_API_KEY = os.getenv("LMSTUDIO_API_KEY", "")
 LMSTUDIO_TIMEOUT = float(os.getenv("LMSTUDIO_TIMEOUT", "60"))
 
 MAX_TOKENS = 64
+# End of the first sentence: terminal punctuation followed by whitespace
+# (so a decimal like "3.5" split across tokens doesn't count), or a line break
+_SENTENCE_END = re.compile(r"[.!?](?=\s)|\n")
+FRAME_CACHE_SIZE = 64
+HASH_DISTANCE = 5  # dHash bits (of 64) that may differ for a frame to count as unchanged
 TEMPERATURE = 1.0
 TOP_K = 64
 TOP_P = 0.95
@@ -64,8 +75,11 @@ PROMPT = (
     "If the image is unclear, say so briefly."
 )
 
-_lock = threading.Lock()
 _last_result = None
+_queue = None  # frames waiting for the inference worker (at most one)
+_worker = None
+http_client = None
+_frame_cache = OrderedDict()  # dHash -> result, least recently used first
 
 
 class ImageRequest(BaseModel):
@@ -76,56 +90,105 @@ def _init_lmstudio():
     logger.info("Using LM Studio model %s @ %s", LMSTUDIO_MODEL, LMSTUDIO_BASE_URL)
 
 
-def _normalize_image_url(image_url: str) -> str:
-    if image_url.startswith("data:"):
-        return image_url
-    return f"data:image/jpeg;base64,{image_url}"
+_DATA_URL_PREFIX = b"data:image/jpeg;base64,"
+
+
+def _decode_image_url(image_url: str) -> tuple[bytes, bytes]:
+    # Returns (data URL as JSON-safe bytes, decoded JPEG)
+    header, sep, b64 = image_url.rpartition(",")
+    try:
+        # SIMD decode; validate=True rejects a malformed frame before PIL or the model
+        jpeg = pybase64.b64decode(b64, validate=True)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="image is not valid base64")
+    # Validated base64 is plain ASCII, so only the short header needs escaping
+    prefix = orjson.dumps(header + sep)[1:-1] if sep else _DATA_URL_PREFIX
+    return prefix + b64.encode("ascii"), jpeg
+
+
+def _frame_hash(jpeg: bytes) -> int | None:
+    # 64-bit dHash: sign of horizontal gradients on a 9x8 grayscale thumbnail
+    if not jpeg:
+        return None
+    try:
+        image = Image.open(io.BytesIO(jpeg))
+        # JPEG only: libjpeg decodes at reduced scale, the hash needs just 9x8
+        image.draft("L", (9, 8))
+        px = image.convert("L").resize((9, 8), Image.BILINEAR).tobytes()
+    except (ValueError, OSError):
+        return None
+    bits = 0
+    for row in range(0, 72, 9):
+        for col in range(row, row + 8):
+            bits = (bits << 1) | (px[col] > px[col + 1])
+    return bits
+
+
+def _cached_result(frame_hash: int | None) -> dict | None:
+    if frame_hash is None:
+        return None
+    for key, result in reversed(_frame_cache.items()):
+        if (key ^ frame_hash).bit_count() <= HASH_DISTANCE:
+            _frame_cache.move_to_end(key)
+            return {**result, "elapsed": 0.0, "cached": True}
+    return None
+
+
+def _remember_result(frame_hash: int | None, result: dict):
+    if frame_hash is None or result["label"] == "ERROR":
+        return
+    _frame_cache[frame_hash] = result
+    _frame_cache.move_to_end(frame_hash)
+    while len(_frame_cache) > FRAME_CACHE_SIZE:
+        _frame_cache.popitem(last=False)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global _queue, _worker, http_client
     _init_lmstudio()
-    yield
+    # Pooled keep-alive connections to LM Studio, reused across frames
+    http_client = httpx.AsyncClient(
+        timeout=LMSTUDIO_TIMEOUT,
+        headers=_HEADERS,
+        limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=60),
+    )
+    _queue = asyncio.Queue(maxsize=1)
+    _worker = asyncio.create_task(_inference_worker())
+    try:
+        yield
+    finally:
+        _worker.cancel()
+        with suppress(asyncio.CancelledError):
+            await _worker
+        await http_client.aclose()
+        http_client = None
 
 
 app = FastAPI(title="WhatYouSee", lifespan=lifespan)
 
 
 def _clean_description(text: str) -> str:
-    if not text:
-        return "No response."
-    line = text.strip().splitlines()[0].strip()
+    text = text.strip()
+    newline = text.find("\n")
+    line = (text[:newline] if newline >= 0 else text).rstrip()
     if not line:
         return "No response."
     if len(line) > 200:
-        return line[:197] + "..."
+        return f"{line[:197]}..."
     return line
 
 
-def _post_json(url: str, payload: dict, timeout: float) -> dict:
-    data = json.dumps(payload).encode("utf-8")
-    headers = {"Content-Type": "application/json"}
-    if LMSTUDIO_API_KEY:
-        headers["Authorization"] = f"Bearer {LMSTUDIO_API_KEY}"
-    req = urllib.request.Request(url, data=data, headers=headers)
-    try:
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            return json.load(resp)
-    except urllib.error.HTTPError as exc:
-        body = exc.read().decode("utf-8", "ignore")
-        raise RuntimeError(f"LM Studio HTTP {exc.code}: {body}") from exc
-
-
-def _analyze_lmstudio(image_url: str) -> dict:
-    start = time.time()
-    image_url = _normalize_image_url(image_url)
+def _chat_body_template() -> tuple[bytes, bytes]:
+    # Everything but the image is constant: serialize it once around a
+    # placeholder so each request only encodes the image string.
     messages = [
         {"role": "system", "content": SYSTEM_PROMPT},
         {
             "role": "user",
             "content": [
                 {"type": "text", "text": PROMPT},
-                {"type": "image_url", "image_url": {"url": image_url}},
+                {"type": "image_url", "image_url": {"url": "__IMAGE__"}},
             ],
         },
     ]
@@ -136,13 +199,46 @@ def _analyze_lmstudio(image_url: str) -> dict:
         "top_k": TOP_K,
         "top_p": TOP_P,
         "max_tokens": MAX_TOKENS,
-        "stream": False,
+        "stream": True,
+        # llama.cpp extension: reuse the KV cache for the unchanged
+        # system + text prefix (the image comes after it); ignored elsewhere
+        "cache_prompt": True,
     }
+    prefix, suffix = orjson.dumps(payload).split(b'"__IMAGE__"')
+    return prefix, suffix
+
+
+_CHAT_BODY_PREFIX, _CHAT_BODY_SUFFIX = _chat_body_template()
+_HEADERS = {"Content-Type": "application/json"}
+if LMSTUDIO_API_KEY:
+    _HEADERS["Authorization"] = f"Bearer {LMSTUDIO_API_KEY}"
+
+
+async def _stream_first_sentence(data: bytes) -> str:
+    # Only the first sentence is shown; leaving the stream closes the
+    # connection, which stops LM Studio generating the rest.
+    text = ""
+    async with http_client.stream("POST", LMSTUDIO_CHAT_URL, content=data) as resp:
+        if resp.status_code >= 400:
+            await resp.aread()
+            raise RuntimeError(f"LM Studio HTTP {resp.status_code}: {resp.text}")
+        async for line in resp.aiter_lines():
+            if not line.startswith("data: ") or line == "data: [DONE]":
+                continue
+            choice = (orjson.loads(line[6:]).get("choices") or [{}])[0]
+            text += (choice.get("delta") or {}).get("content") or ""
+            sentence = text.lstrip()
+            end = _SENTENCE_END.search(sentence)
+            if end:
+                return sentence[: end.end()]
+    return text
+
+
+async def _analyze_lmstudio(image_url: bytes) -> dict:
+    start = time.time()
+    data = b"".join((_CHAT_BODY_PREFIX, b'"', image_url, b'"', _CHAT_BODY_SUFFIX))
     try:
-        response = _post_json(LMSTUDIO_CHAT_URL, payload, timeout=LMSTUDIO_TIMEOUT)
-        choice = (response.get("choices") or [{}])[0]
-        message = choice.get("message") or {}
-        raw = (message.get("content") or "").strip()
+        raw = (await _stream_first_sentence(data)).strip()
         detail = _clean_description(raw)
         return {
             "label": "SEEING",
@@ -165,8 +261,11 @@ def _analyze_lmstudio(image_url: str) -> dict:
 
 
 @app.get("/")
-def index():
-    return HTMLResponse(INDEX_HTML)
+def index(request: Request):
+    headers = {"Cache-Control": "public, max-age=3600", "ETag": _INDEX_ETAG}
+    if request.headers.get("if-none-match") == _INDEX_ETAG:
+        return Response(status_code=304, headers=headers)
+    return Response(content=_INDEX_BYTES, media_type="text/html; charset=utf-8", headers=headers)
 
 
 @app.get("/favicon.ico")
@@ -183,17 +282,21 @@ def config():
     }
 
 
-@app.post("/analyze")
-def analyze(req: ImageRequest):
+def _stale_result() -> dict | Response:
+    if _last_result:
+        logger.info("Frame superseded while busy; returning stale result")
+        return {**_last_result, "stale": True}
+    logger.info("Frame superseded while busy; no cached result")
+    return Response(status_code=429, headers={"Retry-After": "1"})
+
+
+async def _inference_worker():
+    # Sole caller of LM Studio: takes queued frames one at a time
     global _last_result
-    if not _lock.acquire(blocking=False):
-        if _last_result:
-            logger.info("Analyze skipped (busy); returning stale result")
-            return {**_last_result, "stale": True}
-        logger.info("Analyze skipped (busy); no cached result")
-        return {"label": "BUSY", "reason": "busy", "detail": "model busy", "stale": True}
-    try:
-        result = _analyze_lmstudio(req.image)
+    while True:
+        image_url, frame_hash, future = await _queue.get()
+        result = await _analyze_lmstudio(image_url)
+        _remember_result(frame_hash, result)
         _last_result = {**result, "stale": False}
         logger.info(
             "Result %s elapsed=%.2fs",
@@ -201,9 +304,41 @@ def analyze(req: ImageRequest):
             result.get("elapsed", 0),
         )
         logger.debug("Raw output: %s", result.get("raw", ""))
+        if not future.done():
+            future.set_result(_last_result)
+
+
+async def _analyze_frame(image_url: bytes, jpeg: bytes) -> dict | Response:
+    global _last_result
+    # JPEG decode + hash runs off the event loop so / and /config stay responsive
+    frame_hash = await asyncio.to_thread(_frame_hash, jpeg)
+    cached = _cached_result(frame_hash)
+    if cached:
+        logger.info("Frame unchanged; returning cached result")
+        _last_result = {**cached, "stale": False}
         return _last_result
-    finally:
-        _lock.release()
+    future = asyncio.get_running_loop().create_future()
+    if _queue.full():
+        # A frame is already waiting behind the running one: the newest wins
+        _, _, superseded = _queue.get_nowait()
+        if not superseded.done():
+            superseded.set_result(_stale_result())
+    _queue.put_nowait((image_url, frame_hash, future))
+    return await future
+
+
+@app.post("/analyze")
+async def analyze(req: ImageRequest):
+    # Decode in a worker thread; an invalid payload's HTTPException propagates as a 400
+    return await _analyze_frame(*await asyncio.to_thread(_decode_image_url, req.image))
+
+
+@app.post("/analyze_raw")
+async def analyze_raw(request: Request):
+    # Body is the JPEG itself: no base64 or JSON from the browser, one encode here
+    jpeg = await request.body()
+    b64 = await asyncio.to_thread(pybase64.b64encode, jpeg)
+    return await _analyze_frame(_DATA_URL_PREFIX + b64, jpeg)
 
 
 INDEX_HTML = """<!doctype html>
@@ -572,6 +707,7 @@ INDEX_HTML = """<!doctype html>
       let stream;
       let isRunning = false;
       let currentInterval = 2500;
+      const MAX_SIDE = 640;
       let timeoutId;
 
       intervalInput.addEventListener("input", (e) => {
@@ -604,21 +740,26 @@ INDEX_HTML = """<!doctype html>
           timeoutId = setTimeout(loop, 100);
           return;
         }
-        canvas.width = video.videoWidth;
-        canvas.height = video.videoHeight;
+        // Downscale before encoding; the VLM resizes to its own input size anyway
+        const scale = Math.min(1, MAX_SIDE / Math.max(video.videoWidth, video.videoHeight));
+        canvas.width = video.videoWidth * scale | 0;
+        canvas.height = video.videoHeight * scale | 0;
         const ctx = canvas.getContext("2d");
         ctx.translate(canvas.width, 0);
         ctx.scale(-1, 1);
         ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
 
         try {
-          const res = await fetch("/analyze", {
+          const blob = await new Promise((resolve) => canvas.toBlob(resolve, "image/jpeg", 0.8));
+          const res = await fetch("/analyze_raw", {
             method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ image: canvas.toDataURL("image/jpeg", 1.0) }),
+            headers: { "Content-Type": "image/jpeg" },
+            body: blob,
           });
-          const data = await res.json();
-          setStatus(data);
+          // 429: model busy with no result yet; just try again next tick
+          if (res.status !== 429) {
+            setStatus(await res.json());
+          }
         } catch (err) {
           detailEl.textContent = "Error calling server.";
         }
@@ -663,6 +804,8 @@ INDEX_HTML = """<!doctype html>
   </body>
 </html>
 """
+_INDEX_BYTES = INDEX_HTML.encode("utf-8")
+_INDEX_ETAG = f'"{hashlib.md5(_INDEX_BYTES).hexdigest()}"'
 
 
 if __name__ == "__main__":
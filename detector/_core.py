@@ -0,0 +1,43 @@
+"""
+Model helpers shared by server.py and terminal_capture.py.
+
+Loading, prompt templating, warmup and image downscaling are the same for
+both demos; only the model, prompt and token budget differ.
+"""
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from mlx_vlm import load, stream_generate
+from mlx_vlm.prompt_utils import apply_chat_template
+from mlx_vlm.utils import load_config
+
+TEMPERATURE = 0.0
+MAX_IMAGE_SIZE = 384
+
+
+def load_vlm(model_id: str, prompt: str):
+    """Load a vision model and template its (constant) prompt once."""
+    config = load_config(model_id)
+    model, processor = load(model_id)
+    return model, processor, apply_chat_template(processor, config, prompt, num_images=1)
+
+
+def warmup(model, processor, prompt: str):
+    """Run a short dummy generation so kernels compile before the first real frame."""
+    dummy = Image.new("RGB", (MAX_IMAGE_SIZE, MAX_IMAGE_SIZE))
+    for _ in stream_generate(model, processor, prompt, [dummy], max_tokens=4, temperature=TEMPERATURE):
+        pass
+
+
+def resize_image(image: Image.Image, max_side: int) -> Image.Image:
+    """Resize image to fit within max_side."""
+    w, h = image.size
+    scale = max_side / max(w, h)
+    if scale >= 1.0:
+        return image
+    # INTER_AREA averages source pixels per output pixel: no aliasing on
+    # downscale, and faster than PIL bicubic on the post-draft sizes we see
+    size = (int(w * scale), int(h * scale))
+    return Image.fromarray(cv2.resize(np.asarray(image), size, interpolation=cv2.INTER_AREA))
@@ -2,32 +2,40 @@
 Focus Detection Demo - Browser-based webcam monitoring
 
 A FastAPI server that uses a local vision model to detect focus/distraction.
-The browser captures webcam frames and sends them for analysis.
+The browser captures webcam frames and streams them over a WebSocket for analysis.
 
 Requirements:
-    pip install mlx-vlm pillow fastapi uvicorn
+    pip install mlx-vlm pillow pybase64 opencv-python orjson fastapi 'uvicorn[standard]'
 
 Usage:
     python server.py
     # Opens browser to http://localhost:8000
 """
 
-import base64
+import asyncio
+import contextlib
+import gzip
+import hashlib
+import html
 import io
 import logging
 import re
-import threading
 import time
 import webbrowser
+from pathlib import Path
 
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+import orjson
+import pybase64
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
 from pydantic import BaseModel
 from PIL import Image
 
-from mlx_vlm import generate, load
-from mlx_vlm.prompt_utils import apply_chat_template
-from mlx_vlm.utils import load_config
+import mlx.core as mx
+from mlx_vlm import stream_generate
+
+from _core import MAX_IMAGE_SIZE, TEMPERATURE, load_vlm, resize_image, warmup
 
 # Logging setup
 logging.basicConfig(
@@ -39,14 +47,20 @@ logger = logging.getLogger("focus")
 
 # Model options - smaller = faster, larger = better instruction following
 MODEL = "mlx-community/Qwen2-VL-2B-Instruct-4bit"  # 2B, 4-bit - good balance
+# MODEL = "models/Qwen2-VL-2B-Instruct-3bit"  # 2B, 3-bit - ~25% less weight traffic per token
+#   python -m mlx_vlm.convert --hf-path Qwen/Qwen2-VL-2B-Instruct \
+#       --mlx-path models/Qwen2-VL-2B-Instruct-3bit -q --q-bits 3 --q-group-size 64
 # MODEL = "mlx-community/Qwen2.5-VL-3B-Instruct-4bit"  # 3B, 4-bit - newer
 # MODEL = "mlx-community/Phi-3.5-vision-instruct-4bit"  # alternative
 # MODEL = "mlx-community/SmolVLM2-500M-Video-Instruct-mlx-8bit-skip-vision"  # smallest
 
 # Settings
-MAX_TOKENS = 32
-TEMPERATURE = 0.0
-MAX_IMAGE_SIZE = 384
+MAX_TOKENS = 16  # "STATUS: DISTRACTED, REASON: not_looking" is ~12 tokens
+HASH_THRESHOLD = 8  # differing dHash bits (of 256) still treated as the same scene
+# Set to a directory to save every analyzed frame named by its VLM label,
+# e.g. "dataset" -> dataset/DISTRACTED_phone/1712345678901.jpg. This is the
+# training corpus for distilling a small status x reason image classifier.
+COLLECT_DIR = None
 
 # Prompt asking for structured output
 PROMPT = """Look at this webcam image. Is the person focused on their computer or distracted?
@@ -58,9 +72,12 @@ Where reason is one of: attentive, phone, not_looking, no_person"""
 # Global state
 model = None
 processor = None
-config = None
-_lock = threading.Lock()
+prompt = None  # chat-templated PROMPT, built once in init_model
+_queue = None  # frames waiting for the inference worker (at most one)
+_worker = None
 _last_result = None
+_last_hash = None
+_dropped_frames = 0  # frames superseded by a newer one before inference
 
 
 class ImageRequest(BaseModel):
@@ -69,89 +86,128 @@ class ImageRequest(BaseModel):
 
 def init_model():
     """Load the vision model."""
-    global model, processor, config
+    global model, processor, prompt
     logger.info(f"Loading model: {MODEL}")
     start = time.time()
-    config = load_config(MODEL)
-    model, processor = load(MODEL)
+    mx.set_default_device(mx.gpu)
+    model, processor, prompt = load_vlm(MODEL, PROMPT)
     logger.info(f"Model loaded in {time.time() - start:.1f}s")
 
-
-def resize_image(image: Image.Image, max_side: int) -> Image.Image:
-    """Resize image to fit within max_side."""
-    w, h = image.size
-    scale = max_side / max(w, h)
-    if scale >= 1.0:
-        return image
-    return image.resize((int(w * scale), int(h * scale)), Image.BICUBIC)
+    # Warmup: compile Metal kernels now rather than on the first /analyze
+    start = time.time()
+    warmup(model, processor, prompt)
+    logger.info(f"Warmup done in {time.time() - start:.1f}s")
 
 
 def decode_image(data_url: str) -> Image.Image:
     """Decode base64 data URL to PIL Image."""
-    if "," in data_url:
-        data_url = data_url.split(",", 1)[1]
-    return Image.open(io.BytesIO(base64.b64decode(data_url))).convert("RGB")
+    comma = data_url.find(",")
+    return open_jpeg(pybase64.b64decode(data_url[comma + 1:], validate=False))
+
+
+def open_jpeg(data: bytes) -> Image.Image:
+    """Decode raw JPEG bytes to an RGB PIL Image near MAX_IMAGE_SIZE."""
+    image = Image.open(io.BytesIO(data), formats=["JPEG"])
+    # JPEG only: let libjpeg downscale by 1/2..1/8 during the IDCT. It never
+    # goes below the requested size, so resize_image still does the final step.
+    w, h = image.size
+    scale = min(1.0, MAX_IMAGE_SIZE / max(w, h))
+    image.draft("RGB", (int(w * scale), int(h * scale)))
+    # convert() always copies; only pay for it on grayscale/CMYK JPEGs
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
 
 
 VALID_STATUSES = {"FOCUSED", "DISTRACTED"}
+STATUS_WORDS = {"focused", "distracted"}
 VALID_REASONS = {"attentive", "phone", "not_looking", "no_person"}
+NO_PERSON_PHRASES = {"no person", "nobody", "empty"}
+NOT_LOOKING_PHRASES = {"not looking", "looking away"}
+
+# Every keyword parse_response cares about, matched in one scan
+KEYWORD_RE = re.compile(
+    r"distracted|focused|attentive|phone|not_looking|no_person|"
+    r"no person|nobody|empty|not looking|looking away",
+    re.IGNORECASE,
+)
 
 
 def parse_response(text: str) -> tuple[str, str]:
     """Parse model response to extract STATUS and REASON."""
-    text_upper = text.upper()
-    text_lower = text.lower()
-
-    # Try to extract STATUS
-    status = "FOCUSED"  # default
-    if "DISTRACTED" in text_upper:
-        status = "DISTRACTED"
-    elif "FOCUSED" in text_upper:
-        status = "FOCUSED"
-
-    # Try to extract REASON
-    reason = "attentive"  # default
-    for valid_reason in VALID_REASONS:
-        if valid_reason in text_lower:
-            reason = valid_reason
-            break
+    found = {match.lower() for match in KEYWORD_RE.findall(text)}
+
+    status = "DISTRACTED" if "distracted" in found else "FOCUSED"
+    reason = next((r for r in VALID_REASONS if r in found), "attentive")
 
     # Fallback heuristics if model didn't use exact keywords
-    if "phone" in text_lower:
-        reason = "phone"
-        status = "DISTRACTED"
-    elif "no person" in text_lower or "nobody" in text_lower or "empty" in text_lower:
-        reason = "no_person"
-        status = "DISTRACTED"
-    elif "not looking" in text_lower or "looking away" in text_lower:
-        reason = "not_looking"
-        status = "DISTRACTED"
+    if "phone" in found:
+        return "DISTRACTED", "phone"
+    if found & NO_PERSON_PHRASES:
+        return "DISTRACTED", "no_person"
+    if found & NOT_LOOKING_PHRASES:
+        return "DISTRACTED", "not_looking"
 
     return status, reason
 
 
+def is_decided(text: str) -> bool:
+    """Check whether the output already settles what parse_response will return."""
+    found = {match.lower() for match in KEYWORD_RE.findall(text)}
+    # "phone" overrides everything else in parse_response, so it settles the answer alone
+    if "phone" in found:
+        return True
+    return bool(found & STATUS_WORDS) and bool(found & VALID_REASONS)
+
+
+def frame_hash(image: Image.Image) -> int:
+    """256-bit difference hash of a 17x16 grayscale thumbnail."""
+    px = image.convert("L").resize((17, 16), Image.BILINEAR).tobytes()
+    bits = 0
+    for row in range(0, 17 * 16, 17):
+        for i in range(row, row + 16):
+            bits = (bits << 1) | (px[i] > px[i + 1])
+    return bits
+
+
+def save_labeled_frame(image: Image.Image, status: str, reason: str):
+    """Store a frame under COLLECT_DIR/<STATUS>_<reason>/ for classifier training."""
+    label_dir = Path(COLLECT_DIR) / f"{status}_{reason}"
+    label_dir.mkdir(parents=True, exist_ok=True)
+    image.save(label_dir / f"{time.time_ns() // 1_000_000}.jpg", quality=90)
+
+
 def analyze_image(image: Image.Image) -> dict:
     """Run inference and return focus status."""
+    global _last_hash
     image = resize_image(image, MAX_IMAGE_SIZE)
-    prompt = apply_chat_template(processor, config, PROMPT, num_images=1)
+
+    # Near-identical frame: reuse the last answer instead of running the model
+    current_hash = frame_hash(image)
+    if (_last_result and _last_hash is not None
+            and (current_hash ^ _last_hash).bit_count() < HASH_THRESHOLD):
+        return {**_last_result, "elapsed": 0.0}
 
     start = time.time()
-    response = generate(
+    raw = ""
+    for chunk in stream_generate(
         model, processor, prompt, [image],
         max_tokens=MAX_TOKENS,
         temperature=TEMPERATURE,
-    )
+    ):
+        raw += chunk.text
+        # Stop decoding as soon as both answer fields are on the page
+        if is_decided(raw):
+            break
     elapsed = time.time() - start
-
-    # Extract text from GenerationResult object
-    if hasattr(response, 'text'):
-        raw = response.text.strip()
-    else:
-        raw = str(response).strip()
+    raw = raw.strip()
 
     status, reason = parse_response(raw)
 
     logger.info(f"[{elapsed:.2f}s] {status} ({reason}) | {raw[:80]}")
+    _last_hash = current_hash
+    if COLLECT_DIR:
+        save_labeled_frame(image, status, reason)
 
     return {
         "status": status,
@@ -164,37 +220,150 @@ def analyze_image(image: Image.Image) -> dict:
 app = FastAPI(title="Focus Detection Demo")
 
 
+def process_frame(frame: str | bytes) -> dict:
+    """Decode a frame (data URL or raw JPEG) and run the model (blocking)."""
+    image = open_jpeg(frame) if isinstance(frame, bytes) else decode_image(frame)
+    return analyze_image(image)
+
+
+async def inference_worker():
+    """Take queued frames one at a time and resolve their futures."""
+    global _last_result
+    while True:
+        frame, future = await _queue.get()
+        if future.cancelled():
+            continue  # its socket closed while it waited
+        try:
+            result = await run_in_threadpool(process_frame, frame)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            _last_result = result
+            if not future.done():
+                future.set_result(result)
+
+
 @app.on_event("startup")
-def startup():
+async def startup():
+    global _queue, _worker
     init_model()
+    _queue = asyncio.Queue(maxsize=1)
+    _worker = asyncio.create_task(inference_worker())
 
 
-@app.get("/", response_class=HTMLResponse)
-def index():
-    return HTML_PAGE
+@app.get("/")
+def index(request: Request):
+    """Serve the prebuilt page, gzipped if accepted; repeat visits revalidate to a 304."""
+    headers = {"Cache-Control": "public, max-age=3600", "Vary": "Accept-Encoding"}
+    body, etag = INDEX_BYTES, INDEX_ETAG
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        body, etag = INDEX_GZ, INDEX_GZ_ETAG
+        headers["Content-Encoding"] = "gzip"
+    headers["ETag"] = etag
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="text/html; charset=utf-8", headers=headers)
 
 
 @app.get("/config")
 def get_config():
-    return {"model": MODEL.split("/")[-1]}
+    return Response(CONFIG_BYTES, media_type="application/json",
+                    headers={"Cache-Control": "public, max-age=3600"})
+
+
+async def submit_frame(frame: str | bytes) -> dict:
+    """Hand a frame to the inference worker; it replaces any frame still waiting."""
+    global _dropped_frames
+    future = asyncio.get_running_loop().create_future()
+    if _queue.full():
+        _dropped_frames += 1
+        # Worker busy and a frame already waiting: serve the newest one and
+        # answer the superseded request with the last result
+        _, superseded = _queue.get_nowait()
+        if not superseded.done():
+            superseded.set_result(stale_result())
+    _queue.put_nowait((frame, future))
+    return await future
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition of the frame-drop counter."""
+    body = (
+        "# TYPE dropped_frames_total counter\n"
+        f"dropped_frames_total {_dropped_frames}\n"
+    )
+    return Response(body, media_type="text/plain; version=0.0.4")
 
 
-@app.post("/analyze")
-def analyze(req: ImageRequest):
-    global _last_result
+def json_response(result: dict) -> Response:
+    return Response(orjson.dumps(result), media_type="application/json")
 
-    if not _lock.acquire(blocking=False):
-        if _last_result:
-            return {**_last_result, "stale": True}
-        return {"status": "BUSY", "reason": "processing", "stale": True}
 
+@app.post("/analyze")
+async def analyze(req: ImageRequest):
+    return json_response(await submit_frame(req.image))
+
+
+@app.post("/analyze_raw")
+async def analyze_raw(request: Request):
+    """Like /analyze, but the request body is the JPEG itself (no base64)."""
+    return json_response(await submit_frame(await request.body()))
+
+
+def stale_result() -> dict:
+    if _last_result:
+        return {**_last_result, "stale": True}
+    return {"status": "BUSY", "reason": "processing", "stale": True}
+
+
+async def send_result(ws: WebSocket, result: dict):
+    # Text frame so the page can JSON.parse it; orjson does the encoding
+    await ws.send_text(orjson.dumps(result).decode())
+
+
+@app.websocket("/ws")
+async def analyze_stream(ws: WebSocket):
+    """Binary JPEG frames in, JSON results out.
+
+    Receiving runs alongside inference, so the next frame is already
+    uploaded when the model frees up. Only the newest waiting frame is
+    kept; a frame it replaces is answered with the last result.
+    """
+    global _dropped_frames
+    await ws.accept()
+    pending = asyncio.Queue(maxsize=1)
+
+    async def infer_loop():
+        while True:
+            frame = await pending.get()
+            future = asyncio.get_running_loop().create_future()
+            await _queue.put((frame, future))
+            try:
+                result = await future
+            except Exception as e:
+                result = {"status": "ERROR", "reason": "error", "raw": str(e)}
+            try:
+                await send_result(ws, result)
+            except (WebSocketDisconnect, RuntimeError):
+                return
+
+    infer_task = asyncio.create_task(infer_loop())
     try:
-        image = decode_image(req.image)
-        result = analyze_image(image)
-        _last_result = result
-        return result
+        while True:
+            frame = await ws.receive_bytes()
+            if pending.full():
+                _dropped_frames += 1
+                pending.get_nowait()
+                await send_result(ws, stale_result())
+            pending.put_nowait(frame)
+    except WebSocketDisconnect:
+        pass
     finally:
-        _lock.release()
+        infer_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError, WebSocketDisconnect, RuntimeError):
+            await infer_task
 
 
 HTML_PAGE = """<!DOCTYPE html>
@@ -353,7 +522,7 @@ HTML_PAGE = """<!DOCTYPE html>
     <div class="container">
         <h1>Focus Detection</h1>
         <p class="subtitle">Local vision model monitoring your focus in real-time</p>
-        <div class="model-chip" id="model">Loading...</div>
+        <div class="model-chip" id="model">__MODEL__</div>
 
         <div class="main-grid">
             <div class="panel">
@@ -403,6 +572,7 @@ HTML_PAGE = """<!DOCTYPE html>
     <script>
         const video = document.getElementById('video');
         const canvas = document.getElementById('canvas');
+        const ctx = canvas.getContext('2d', { alpha: false });
         const badge = document.getElementById('badge');
         const startBtn = document.getElementById('startBtn');
         const stopBtn = document.getElementById('stopBtn');
@@ -413,17 +583,11 @@ HTML_PAGE = """<!DOCTYPE html>
         const latencyEl = document.getElementById('latency');
         const freshnessEl = document.getElementById('freshness');
         const rawEl = document.getElementById('raw');
-        const modelEl = document.getElementById('model');
 
         let stream = null;
         let running = false;
         let timeoutId = null;
 
-        // Load config
-        fetch('/config').then(r => r.json()).then(data => {
-            modelEl.textContent = data.model;
-        });
-
         intervalSlider.oninput = () => {
             intervalValue.textContent = (intervalSlider.value / 1000).toFixed(1) + 's';
         };
@@ -440,33 +604,94 @@ HTML_PAGE = """<!DOCTYPE html>
             rawEl.textContent = data.raw || 'No output';
         }
 
-        async function captureAndAnalyze() {
-            if (!running || !video.videoWidth) {
-                if (running) timeoutId = setTimeout(captureAndAnalyze, 100);
+        // Frames go over one WebSocket. Up to two are in flight, so the next
+        // frame uploads while the model is still busy with the current one.
+        // A frame is only captured when a slot is free, and a reply frees the
+        // slot immediately, so nothing is encoded just to be dropped.
+        const MAX_IN_FLIGHT = 2;
+        // A reply that never arrives on an open socket (e.g. the server dropped
+        // the frame) must not block capture forever; closes are handled in onclose
+        const WATCHDOG_MS = 5000;
+        let ws = null;
+        let inFlight = 0;
+        let lastSent = 0;
+        let watchdogId = null;
+        // Reconnect backoff after the socket drops: doubles up to the cap
+        const RECONNECT_MAX_MS = 5000;
+        let reconnectDelay = 500;
+        let reconnectId = null;
+
+        function connect() {
+            const proto = location.protocol === 'https:' ? 'wss' : 'ws';
+            const sock = new WebSocket(`${proto}://${location.host}/ws`);
+            ws = sock;
+            sock.onopen = () => {
+                reconnectDelay = 500;
+                captureAndSend();
+            };
+            sock.onmessage = (e) => {
+                inFlight = Math.max(0, inFlight - 1);
+                updateUI(JSON.parse(e.data));
+                captureAndSend();
+            };
+            sock.onclose = () => {
+                // Ignore sockets replaced by Stop/Start
+                if (!running || sock !== ws) return;
+                rawEl.textContent = 'Error: connection closed, reconnecting...';
+                // Replies for frames sent on the dead socket will never come
+                inFlight = 0;
+                reconnectId = setTimeout(connect, reconnectDelay);
+                reconnectDelay = Math.min(reconnectDelay * 2, RECONNECT_MAX_MS);
+            };
+        }
+
+        function resetWatchdog() {
+            clearTimeout(watchdogId);
+            if (inFlight === 0) return;
+            watchdogId = setTimeout(() => {
+                inFlight = 0;
+                captureAndSend();
+            }, WATCHDOG_MS);
+        }
+
+        function captureAndSend() {
+            clearTimeout(timeoutId);
+            resetWatchdog();
+            if (!running) return;
+            if (!video.videoWidth || ws.readyState !== WebSocket.OPEN) {
+                timeoutId = setTimeout(captureAndSend, 100);
                 return;
             }
+            // Slots full: the next reply calls back in here
+            if (inFlight >= MAX_IN_FLIGHT) return;
 
-            canvas.width = video.videoWidth;
-            canvas.height = video.videoHeight;
-            const ctx = canvas.getContext('2d');
-            // Don't flip - send original orientation to model so text is readable
-            ctx.drawImage(video, 0, 0);
-
-            try {
-                const res = await fetch('/analyze', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({image: canvas.toDataURL('image/jpeg', 0.8)})
-                });
-                const data = await res.json();
-                updateUI(data);
-            } catch (e) {
-                rawEl.textContent = 'Error: ' + e.message;
+            const wait = lastSent + parseInt(intervalSlider.value) - performance.now();
+            if (wait > 0) {
+                timeoutId = setTimeout(captureAndSend, wait);
+                return;
             }
 
-            if (running) {
-                timeoutId = setTimeout(captureAndAnalyze, parseInt(intervalSlider.value));
+            // Downscale before encoding; the server resizes to 384 anyway
+            const scale = Math.min(1, 384 / Math.max(video.videoWidth, video.videoHeight));
+            const w = video.videoWidth * scale | 0;
+            const h = video.videoHeight * scale | 0;
+            // Resizing clears and reallocates the backing store, so only do it on change
+            if (canvas.width !== w || canvas.height !== h) {
+                canvas.width = w;
+                canvas.height = h;
             }
+            // Don't flip - send original orientation to model so text is readable
+            ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
+
+            inFlight++;
+            lastSent = performance.now();
+            resetWatchdog();
+            canvas.toBlob((blob) => {
+                if (blob && ws.readyState === WebSocket.OPEN) ws.send(blob);
+                else inFlight = Math.max(0, inFlight - 1);
+            }, 'image/jpeg', 0.6);
+
+            timeoutId = setTimeout(captureAndSend, parseInt(intervalSlider.value));
         }
 
         startBtn.onclick = async () => {
@@ -474,9 +699,10 @@ HTML_PAGE = """<!DOCTYPE html>
                 stream = await navigator.mediaDevices.getUserMedia({video: true});
                 video.srcObject = stream;
                 running = true;
+                inFlight = 0;
                 startBtn.disabled = true;
                 stopBtn.disabled = false;
-                captureAndAnalyze();
+                connect();
             } catch (e) {
                 alert('Camera error: ' + e.message);
             }
@@ -485,6 +711,9 @@ HTML_PAGE = """<!DOCTYPE html>
         stopBtn.onclick = () => {
             running = false;
             clearTimeout(timeoutId);
+            clearTimeout(watchdogId);
+            clearTimeout(reconnectId);
+            if (ws) ws.close();
             if (stream) stream.getTracks().forEach(t => t.stop());
             startBtn.disabled = false;
             stopBtn.disabled = true;
@@ -496,10 +725,20 @@ HTML_PAGE = """<!DOCTYPE html>
 </html>
 """
 
+# Page and config are fixed once MODEL is set, so build the bytes once
+MODEL_NAME = MODEL.split("/")[-1]
+INDEX_BYTES = HTML_PAGE.replace("__MODEL__", html.escape(MODEL_NAME)).encode("utf-8")
+INDEX_GZ = gzip.compress(INDEX_BYTES, compresslevel=9, mtime=0)
+INDEX_ETAG = f'"{hashlib.md5(INDEX_BYTES).hexdigest()}"'
+INDEX_GZ_ETAG = f'"{hashlib.md5(INDEX_GZ).hexdigest()}"'
+CONFIG_BYTES = orjson.dumps({"model": MODEL_NAME})
+
 
 if __name__ == "__main__":
     import uvicorn
     print("Starting Focus Detection Demo...")
     print("Opening browser to http://localhost:8000")
     webbrowser.open("http://localhost:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvicorn[standard] brings uvloop + httptools, which loop/http "auto" pick up;
+    # the per-frame access log line is dropped
+    uvicorn.run(app, host="0.0.0.0", port=8000, access_log=False)
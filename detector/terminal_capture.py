@@ -11,22 +11,26 @@ Usage:
     python terminal_capture.py
 """
 
+import re
 import time
 import cv2
 from PIL import Image
 
-from mlx_vlm import generate, load
-from mlx_vlm.prompt_utils import apply_chat_template
-from mlx_vlm.utils import load_config
+from mlx_vlm import stream_generate
+
+from _core import MAX_IMAGE_SIZE, TEMPERATURE, load_vlm, resize_image, warmup
 
 # Model options - uncomment the one you want to use
 MODEL = "mlx-community/SmolVLM2-500M-Video-Instruct-mlx-8bit-skip-vision"
 # MODEL = "EZCon/SmolVLM2-2.2B-Instruct-4bit-mlx"
 
 # Generation settings
-MAX_TOKENS = 64
-TEMPERATURE = 0.0
-MAX_IMAGE_SIZE = 384
+MAX_TOKENS = 32  # cap only; decoding stops at the end of the first sentence
+# End of the first sentence: terminal punctuation followed by whitespace
+# (so a decimal like "3.5" split across tokens doesn't count), or a line break
+SENTENCE_END = re.compile(r"[.!?](?=\s)|\n")
+# Frames the capture backend may have queued while inference blocked the loop
+STALE_FRAMES = 4
 
 PROMPT = "What do you see in this image? Describe it in one sentence."
 
@@ -36,20 +40,24 @@ def load_model():
     print(f"Loading model: {MODEL}")
     start = time.time()
 
-    config = load_config(MODEL)
-    model, processor = load(MODEL)
-
+    model, processor, prompt = load_vlm(MODEL, PROMPT)
     print(f"Model loaded in {time.time() - start:.1f}s")
-    return model, processor, config
+
+    # Warmup: compile Metal kernels now rather than on the first SPACE
+    start = time.time()
+    warmup(model, processor, prompt)
+    print(f"Warmup done in {time.time() - start:.1f}s")
+    return model, processor, prompt
 
 
-def resize_image(image: Image.Image, max_side: int) -> Image.Image:
-    """Resize image to fit within max_side while preserving aspect ratio."""
-    w, h = image.size
-    scale = max_side / max(w, h)
-    if scale >= 1.0:
-        return image
-    return image.resize((int(w * scale), int(h * scale)), Image.BICUBIC)
+def frame_to_image(frame) -> Image.Image:
+    """Downscale a BGR webcam frame while still an array, then convert to PIL RGB."""
+    h, w = frame.shape[:2]
+    scale = MAX_IMAGE_SIZE / max(w, h)
+    if scale < 1.0:
+        frame = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    # Convert BGR to RGB
+    return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
 
 
 def capture_frame(cap) -> Image.Image | None:
@@ -57,36 +65,33 @@ def capture_frame(cap) -> Image.Image | None:
     ret, frame = cap.read()
     if not ret:
         return None
-    # Convert BGR to RGB
-    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    return Image.fromarray(frame_rgb)
+    return frame_to_image(frame)
 
 
-def describe_image(model, processor, config, image: Image.Image) -> tuple[str, float]:
+def describe_image(model, processor, prompt: str, image: Image.Image) -> tuple[str, float]:
     """Run inference on an image and return description + elapsed time."""
     image = resize_image(image, MAX_IMAGE_SIZE)
-    prompt = apply_chat_template(processor, config, PROMPT, num_images=1)
 
     start = time.time()
-    response = generate(
+    text = ""
+    for chunk in stream_generate(
         model,
         processor,
         prompt,
         [image],
         max_tokens=MAX_TOKENS,
         temperature=TEMPERATURE,
-    )
+    ):
+        text += chunk.text
+        # Only the first sentence is shown, so stop decoding once it ends
+        end = SENTENCE_END.search(text.lstrip())
+        if end:
+            text = text.lstrip()[: end.end()]
+            break
     elapsed = time.time() - start
 
-    # Extract text from GenerationResult object
-    if hasattr(response, 'text'):
-        text = response.text.strip()
-    else:
-        text = str(response).strip()
-
     # Clean up - take first line only
-    if "\n" in text:
-        text = text.split("\n")[0]
+    text = text.strip().split("\n")[0]
 
     return text, elapsed
 
@@ -98,7 +103,7 @@ def main():
     print()
 
     # Load model
-    model, processor, config = load_model()
+    model, processor, prompt = load_model()
     print()
 
     # Open webcam
@@ -107,6 +112,8 @@ def main():
     if not cap.isOpened():
         print("Error: Could not open webcam")
         return
+    # Keep only the newest frame queued; not every backend honours this
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 
     print("Webcam ready. Press 'q' to quit, SPACE to capture.")
     print()
@@ -135,15 +142,18 @@ def main():
                 # Capture and analyze (use ORIGINAL unflipped frame for model)
                 print("Capturing...")
 
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                image = Image.fromarray(frame_rgb)
+                image = frame_to_image(frame)
 
                 # Run inference
-                description, elapsed = describe_image(model, processor, config, image)
+                description, elapsed = describe_image(model, processor, prompt, image)
 
                 print(f"[{elapsed:.2f}s] {description}")
                 print()
 
+                # Drop frames buffered during inference so the preview is live again
+                for _ in range(STALE_FRAMES):
+                    cap.grab()
+
     finally:
         cap.release()
         cv2.destroyAllWindows()